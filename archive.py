@@ -0,0 +1,495 @@
+import os
+import json
+import re
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from utils import CACHE_DIR
+
+ARCHIVE_DIR = os.path.join(CACHE_DIR, "archive")
+
+# The archive holds two datasets: the listings seen in every scrape, and a log of every scrape
+# (including the ones that found no listings). The 'site' and 'date' columns are not stored in
+# the files themselves: they are encoded in the directory layout (site=<name>/date=<YYYY-MM-DD>/).
+LISTINGS_DATASET = "listings"
+SCRAPES_DATASET = "scrapes"
+
+SNAPSHOT_SCHEMA = pa.schema(
+    [
+        ("scraped_at", pa.timestamp("us", tz="UTC")),
+        ("address", pa.string()),
+        ("cost", pa.string()),
+        ("basic_rent", pa.float64()),
+        ("total_rent", pa.float64()),
+        ("link", pa.string()),
+    ]
+)
+SCRAPE_SCHEMA = pa.schema(
+    [
+        ("scraped_at", pa.timestamp("us", tz="UTC")),
+        ("listings", pa.int32()),
+    ]
+)
+PARTITION_SCHEMA = pa.schema([("site", pa.string()), ("date", pa.date32())])
+
+COMPACTED_FILE_NAME = "compacted.parquet"
+# Schema metadata key of the compacted file listing the source files merged into it
+COVERED_SOURCES_KEY = "covered_sources"
+LOCK_FILE_NAME = ".compact.lock"
+# Seconds after which a compaction lock is considered left over by a crashed run
+LOCK_TIMEOUT = 600
+# Number of times a query is attempted when a concurrent compaction removes a file it listed
+QUERY_ATTEMPTS = 3
+
+
+def parse_amount(amount):
+    """
+    Parses a euro amount such as '€650.00', '€ 1,050.00' or '€1.050,00' into a float.
+
+    Args:
+        amount (str): The amount string.
+
+    Returns:
+        float: The parsed amount, or None if no number could be found.
+    """
+    match = re.search(r"\d[\d.,]*", amount or "")
+    if not match:
+        return None
+    number = match.group().rstrip(".,")
+
+    if "," in number and "." in number:
+        # Whichever separator comes last is the decimal separator
+        decimal_separator = "," if number.rfind(",") > number.rfind(".") else "."
+    elif "," in number or "." in number:
+        separator = "," if "," in number else "."
+        # A single separator followed by one or two digits is a decimal separator,
+        # otherwise it is a thousands separator (e.g. '1.050')
+        decimals = number.split(separator)
+        is_decimal = len(decimals) == 2 and len(decimals[1]) in (1, 2)
+        decimal_separator = separator if is_decimal else None
+    else:
+        decimal_separator = None
+
+    for separator in ",.":
+        if separator != decimal_separator:
+            number = number.replace(separator, "")
+    if decimal_separator:
+        number = number.replace(decimal_separator, ".")
+
+    try:
+        return float(number)
+    except ValueError:
+        return None
+
+
+def parse_rent(cost):
+    """
+    Parses the cost string built by the scrapers, i.e. '<basic rent> (total: <total rent>)',
+    into numeric basic and total rent.
+
+    Args:
+        cost (str): The cost string of a rental place.
+
+    Returns:
+        tuple: The basic rent and the total rent as floats. Either can be None if not parseable.
+    """
+    match = re.match(r"^(.*?)\(total:\s*(.*?)\)\s*$", cost or "")
+    if not match:
+        return parse_amount(cost), None
+    return parse_amount(match.group(1)), parse_amount(match.group(2))
+
+
+def _dataset_schema(dataset):
+    """
+    Returns the schema of the columns stored in the files of the given dataset.
+    """
+    return SNAPSHOT_SCHEMA if dataset == LISTINGS_DATASET else SCRAPE_SCHEMA
+
+
+def _partition_dir(dataset, website_name, day):
+    """
+    Returns the directory of the partition of a dataset for the given website and day.
+    """
+    return os.path.join(
+        ARCHIVE_DIR, dataset, f"site={website_name.lower()}", f"date={day.isoformat()}"
+    )
+
+
+def _write_table_atomically(table, file_path):
+    """
+    Writes a table to a Parquet file through a uniquely named hidden temporary file, so that
+    readers never see a partially written file and concurrent writers never share a temp file.
+    """
+    directory, file_name = os.path.split(file_path)
+    fd, tmp_file_path = tempfile.mkstemp(
+        prefix=f".{file_name}.", suffix=".tmp", dir=directory
+    )
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp_file_path, compression="zstd")
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        raise
+
+
+def _read_file(file_path):
+    """
+    Reads a Parquet file, returning None if it does not exist.
+    """
+    try:
+        return pq.ParquetFile(file_path).read()
+    except FileNotFoundError:
+        return None
+
+
+def _source_file_names(partition_dir):
+    """
+    Returns the names of the snapshot files of a partition that are not the compacted file.
+    """
+    return sorted(
+        file_name
+        for file_name in os.listdir(partition_dir)
+        if file_name.endswith(".parquet")
+        and not file_name.startswith((".", "_"))
+        and file_name != COMPACTED_FILE_NAME
+    )
+
+
+def _covered_source_names(compacted_schema):
+    """
+    Returns the names of the source files already merged into a compacted file, as recorded
+    in its schema metadata.
+    """
+    metadata = compacted_schema.metadata or {}
+    return set(json.loads(metadata.get(COVERED_SOURCES_KEY.encode(), b"[]")))
+
+
+def _acquire_lock(lock_path):
+    """
+    Tries to create the lock file of a partition. A lock older than LOCK_TIMEOUT seconds is
+    considered left over by a crashed run and is taken over.
+
+    Returns:
+        bool: True if the lock was acquired, False if it is held by another run.
+    """
+    for _ in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) < LOCK_TIMEOUT:
+                    return False
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+    return False
+
+
+def compact_partition(dataset, website_name, day):
+    """
+    Merges all the files of a (website, day) partition of a dataset into a single file. This
+    keeps the number of files (and thus the query overhead) low when scraping every few minutes.
+
+    Compaction of a partition is serialized through a lock file: if another run is already
+    compacting it, this call does nothing. The compacted file records which source files it
+    covers, so readers skip them until they are removed, and rows of scrapes that are already
+    in the compacted file are never merged twice. Compaction is thus safe to re-run after an
+    interruption.
+
+    Args:
+        dataset (str): The dataset, either LISTINGS_DATASET or SCRAPES_DATASET.
+        website_name (str): The name of the website.
+        day (datetime.date): The day of the partition.
+    """
+    partition_dir = _partition_dir(dataset, website_name, day)
+    lock_path = os.path.join(partition_dir, LOCK_FILE_NAME)
+    if not _acquire_lock(lock_path):
+        return
+
+    try:
+        compacted_file_path = os.path.join(partition_dir, COMPACTED_FILE_NAME)
+        source_file_names = _source_file_names(partition_dir)
+        if not source_file_names:
+            return
+        if len(source_file_names) == 1 and not os.path.exists(compacted_file_path):
+            return
+
+        compacted = _read_file(compacted_file_path)
+        if compacted is None:
+            compacted = _dataset_schema(dataset).empty_table()
+        covered_source_names = _covered_source_names(compacted.schema)
+        compacted_scrapes = pc.unique(compacted["scraped_at"])
+
+        tables = [compacted.replace_schema_metadata(None)]
+        for file_name in source_file_names:
+            if file_name in covered_source_names:
+                continue
+            # The lock guarantees that no other run removes the source files meanwhile
+            table = pq.ParquetFile(os.path.join(partition_dir, file_name)).read()
+            is_new = pc.invert(pc.is_in(table["scraped_at"], value_set=compacted_scrapes))
+            tables.append(table.filter(is_new))
+
+        covered_source_names.update(source_file_names)
+        table = (
+            pa.concat_tables(tables)
+            .sort_by("scraped_at")
+            .replace_schema_metadata(
+                {COVERED_SOURCES_KEY: json.dumps(sorted(covered_source_names))}
+            )
+        )
+        _write_table_atomically(table, compacted_file_path)
+
+        for file_name in source_file_names:
+            os.remove(os.path.join(partition_dir, file_name))
+    finally:
+        os.remove(lock_path)
+
+
+def _compact_past_partitions(dataset, website_name, today):
+    """
+    Compacts all the partitions of a dataset for a website that are older than today.
+    """
+    site_dir = os.path.join(ARCHIVE_DIR, dataset, f"site={website_name.lower()}")
+    if not os.path.isdir(site_dir):
+        return
+    for dir_name in os.listdir(site_dir):
+        if not dir_name.startswith("date="):
+            continue
+        day = datetime.strptime(dir_name[len("date="):], "%Y-%m-%d").date()
+        if day < today:
+            compact_partition(dataset, website_name, day)
+
+
+def _append_table(dataset, website_name, table, scraped_at):
+    """
+    Writes a table as a new file in the partition of the website and (UTC) day of the scrape.
+    """
+    partition_dir = _partition_dir(dataset, website_name, scraped_at.date())
+    os.makedirs(partition_dir, exist_ok=True)
+    file_path = os.path.join(
+        partition_dir, f"{scraped_at.strftime('%H%M%S%f')}.parquet"
+    )
+    _write_table_atomically(table, file_path)
+    return file_path
+
+
+def append_snapshot(website_name, items, scraped_at=None):
+    """
+    Appends a snapshot of the current rental places to the archive, as a compressed Parquet
+    file in the partition of the website and (UTC) day of the scrape. Every scrape is also
+    recorded in the scrape log, including the ones that found no rental places, so that
+    "no listings" can be told apart from "the scraper did not run". Partitions of past days
+    are compacted into a single file.
+
+    Args:
+        website_name (str): The name of the website.
+        items (list): A list of dictionaries representing the current rental places.
+        scraped_at (datetime, optional): The time of the scrape. Defaults to now.
+
+    Returns:
+        str: The path to the written listings file, or None if no rental places were found.
+    """
+    scraped_at = (scraped_at or datetime.now(timezone.utc)).astimezone(timezone.utc)
+
+    file_path = None
+    if items:
+        rows = []
+        for item in items:
+            basic_rent, total_rent = parse_rent(item.get("cost"))
+            rows.append(
+                {
+                    "scraped_at": scraped_at,
+                    "address": item.get("address"),
+                    "cost": item.get("cost"),
+                    "basic_rent": basic_rent,
+                    "total_rent": total_rent,
+                    "link": item.get("link"),
+                }
+            )
+        table = pa.Table.from_pylist(rows, schema=SNAPSHOT_SCHEMA)
+        file_path = _append_table(LISTINGS_DATASET, website_name, table, scraped_at)
+
+    # Log the scrape last, so that a logged scrape always has its listings archived
+    scrape = pa.Table.from_pylist(
+        [{"scraped_at": scraped_at, "listings": len(items)}], schema=SCRAPE_SCHEMA
+    )
+    _append_table(SCRAPES_DATASET, website_name, scrape, scraped_at)
+
+    for dataset in (LISTINGS_DATASET, SCRAPES_DATASET):
+        _compact_past_partitions(dataset, website_name, scraped_at.date())
+
+    return file_path
+
+
+def _archive_filter(sites=None, start=None, end=None, filter=None):
+    """
+    Builds the filter expression for the given sites and (inclusive) date range. Conditions on
+    'site' and 'date' only touch partition columns, so non-matching files are never opened.
+    """
+    conditions = []
+    if sites is not None:
+        conditions.append(ds.field("site").isin([site.lower() for site in sites]))
+    if start is not None:
+        conditions.append(ds.field("date") >= start)
+    if end is not None:
+        conditions.append(ds.field("date") <= end)
+    if filter is not None:
+        conditions.append(filter)
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _archive_file_paths(dataset, sites=None, start=None, end=None):
+    """
+    Lists the files of the partitions of a dataset matching the sites and (inclusive) date
+    range. Source files already merged into the compacted file of their partition are left
+    out, so that no row is read twice while a compaction is removing them.
+    """
+    dataset_dir = os.path.join(ARCHIVE_DIR, dataset)
+    if not os.path.isdir(dataset_dir):
+        return []
+    site_names = None if sites is None else {site.lower() for site in sites}
+
+    file_paths = []
+    for site_dir_name in sorted(os.listdir(dataset_dir)):
+        if not site_dir_name.startswith("site="):
+            continue
+        if site_names is not None and site_dir_name[len("site="):] not in site_names:
+            continue
+        site_dir = os.path.join(dataset_dir, site_dir_name)
+        for date_dir_name in sorted(os.listdir(site_dir)):
+            if not date_dir_name.startswith("date="):
+                continue
+            day = datetime.strptime(date_dir_name[len("date="):], "%Y-%m-%d").date()
+            if (start is not None and day < start) or (end is not None and day > end):
+                continue
+
+            partition_dir = os.path.join(site_dir, date_dir_name)
+            covered_source_names = set()
+            compacted_file_path = os.path.join(partition_dir, COMPACTED_FILE_NAME)
+            if os.path.exists(compacted_file_path):
+                file_paths.append(compacted_file_path)
+                covered_source_names = _covered_source_names(
+                    pq.read_schema(compacted_file_path)
+                )
+            file_paths.extend(
+                os.path.join(partition_dir, file_name)
+                for file_name in _source_file_names(partition_dir)
+                if file_name not in covered_source_names
+            )
+
+    return file_paths
+
+
+def _archive_dataset(dataset, sites=None, start=None, end=None):
+    """
+    Returns the matching partitions of a dataset of the archive as a pyarrow Dataset, with
+    'site' and 'date' as partition columns, or None if there are no matching files.
+    """
+    file_paths = _archive_file_paths(dataset, sites, start, end)
+    if not file_paths:
+        return None
+
+    return ds.dataset(
+        file_paths,
+        schema=pa.unify_schemas([_dataset_schema(dataset), PARTITION_SCHEMA]),
+        format="parquet",
+        partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"),
+        partition_base_dir=os.path.join(ARCHIVE_DIR, dataset),
+    )
+
+
+def _query(dataset, columns, sites, start, end, filter):
+    """
+    Reads the matching rows of a dataset into a pyarrow Table. If a file is removed by a
+    concurrent compaction while reading, the files are listed and read again.
+    """
+    for attempt in range(QUERY_ATTEMPTS):
+        archive_dataset = _archive_dataset(dataset, sites, start, end)
+        if archive_dataset is None:
+            schema = pa.unify_schemas([_dataset_schema(dataset), PARTITION_SCHEMA])
+            if columns is not None:
+                schema = pa.schema([schema.field(column) for column in columns])
+            return schema.empty_table()
+
+        try:
+            return archive_dataset.to_table(
+                columns=columns, filter=_archive_filter(sites, start, end, filter)
+            )
+        except FileNotFoundError:
+            if attempt == QUERY_ATTEMPTS - 1:
+                raise
+
+
+def query_archive(columns=None, sites=None, start=None, end=None, filter=None):
+    """
+    Reads the archived rental places into a pyarrow Table. Only the requested columns and the
+    partitions matching the sites and date range are read.
+
+    Queries can run while scrapers append and compact: source files already merged into a
+    compacted file are skipped, and the query is retried if a compaction removes a file while
+    it is being read. Only a compaction finishing between listing the files and reading them
+    can make a query return the rows of a scrape twice.
+
+    Example:
+        >>> table = query_archive(
+        ...     columns=["scraped_at", "total_rent"],
+        ...     sites=["Maasland"],
+        ...     start=date(2024, 9, 1),
+        ... )
+
+    Args:
+        columns (list, optional): The columns to read, among the snapshot columns plus 'site'
+            and 'date'. Defaults to all columns.
+        sites (list, optional): The names of the websites to read. Defaults to all websites.
+        start (datetime.date, optional): The first day to read (inclusive).
+        end (datetime.date, optional): The last day to read (inclusive).
+        filter (pyarrow.dataset.Expression, optional): An additional row filter,
+            e.g. `pyarrow.dataset.field("total_rent") < 800`.
+
+    Returns:
+        pyarrow.Table: The matching rows.
+    """
+    return _query(LISTINGS_DATASET, columns, sites, start, end, filter)
+
+
+def query_scrapes(columns=None, sites=None, start=None, end=None, filter=None):
+    """
+    Reads the scrape log into a pyarrow Table, with one row per scrape holding its time and
+    the number of rental places found. Takes the same arguments as `query_archive`.
+
+    Returns:
+        pyarrow.Table: The matching scrapes.
+    """
+    return _query(SCRAPES_DATASET, columns, sites, start, end, filter)
+
+
+def iter_archive_batches(columns=None, sites=None, start=None, end=None, filter=None):
+    """
+    Streams the archived rental places as pyarrow RecordBatches, so that aggregations over
+    long periods can be computed without holding all the rows in memory. Takes the same
+    arguments as `query_archive`. Unlike `query_archive`, a stream is not retried if a
+    concurrent compaction removes a file it is about to read: `FileNotFoundError` is raised.
+
+    Yields:
+        pyarrow.RecordBatch: The matching rows, batch by batch.
+    """
+    archive_dataset = _archive_dataset(LISTINGS_DATASET, sites, start, end)
+    if archive_dataset is None:
+        return
+
+    yield from archive_dataset.to_batches(
+        columns=columns, filter=_archive_filter(sites, start, end, filter)
+    )
@@ -324,6 +324,15 @@ def main():
     # Extract the properties of the relevant rental places
     current_items = fetch_relevant_properties(properties_urls, driver, wait)
 
+    # Append the current snapshot (links included) to the archive for market history queries.
+    # The archive is imported here so that a missing or broken pyarrow never blocks the emails.
+    try:
+        from archive import append_snapshot
+
+        append_snapshot(WEBSITE_NAME, current_items)
+    except Exception as e:
+        print(f"Failed to archive snapshot: {e}")
+
     # Now compare the newly found properties with the previous ones and send email if needed
     previous_items = load_previous_items(JSON_FILE_PATH)
 
@@ -167,6 +167,15 @@ def main():
         print(f"Error: {e}")
         return
 
+    # Append the current snapshot (links included) to the archive for market history queries.
+    # The archive is imported here so that a missing or broken pyarrow never blocks the emails.
+    try:
+        from archive import append_snapshot
+
+        append_snapshot(WEBSITE_NAME, current_items)
+    except Exception as e:
+        print(f"Failed to archive snapshot: {e}")
+
     previous_items = load_previous_items(JSON_FILE_PATH)
 
     current_items_without_links = [
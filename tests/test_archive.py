@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+from datetime import date, datetime, timezone
+
+import pytest
+
+# Add the parent directory to the sys.path to import the archive module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive
+from archive import (
+    append_snapshot,
+    compact_partition,
+    parse_amount,
+    parse_rent,
+    query_archive,
+    query_scrapes,
+    LISTINGS_DATASET,
+)
+
+ITEMS = [
+    {"address": "Street 1", "cost": "€650.00 (total: €720.00)", "link": "https://a/1"},
+    {"address": "Street 2", "cost": "€ 700.00(total: € 780.50)", "link": "https://a/2"},
+    {"address": "Street 3", "cost": "€ 1.234,56(total: € 1.300,-)", "link": "https://a/3"},
+]
+
+
+@pytest.fixture(autouse=True)
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    return tmp_path / "archive"
+
+
+@pytest.mark.parametrize(
+    "amount, expected",
+    [
+        ("€650.00", 650.0),
+        ("€ 1,050.00", 1050.0),
+        ("€ 1.234,56", 1234.56),
+        ("€1.050", 1050.0),
+        ("€650,-", 650.0),
+        ("€ 650,5", 650.5),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_parse_amount(amount, expected):
+    assert parse_amount(amount) == expected
+
+
+@pytest.mark.parametrize(
+    "cost, expected",
+    [
+        # Maasland
+        ("€650.00 (total: €720.00)", (650.0, 720.0)),
+        ("€1,050.00 (total: €1,120.00)", (1050.0, 1120.0)),
+        # Plaza
+        ("€ 650.00(total: € 720.00)", (650.0, 720.0)),
+        ("€ 1.234,56(total: € 1.300,-)", (1234.56, 1300.0)),
+        ("€650", (650.0, None)),
+        ("", (None, None)),
+    ],
+)
+def test_parse_rent(cost, expected):
+    assert parse_rent(cost) == expected
+
+
+def test_append_compact_query_round_trip():
+    for minute in (0, 5, 10):
+        append_snapshot(
+            "Plaza", ITEMS, datetime(2024, 9, 1, 12, minute, tzinfo=timezone.utc)
+        )
+    append_snapshot("Maasland", ITEMS[:1], datetime(2024, 9, 1, 12, tzinfo=timezone.utc))
+    # A scrape on the next day compacts the partitions of the previous day
+    append_snapshot("Plaza", ITEMS[:1], datetime(2024, 9, 2, 12, tzinfo=timezone.utc))
+
+    partition_dir = archive._partition_dir(LISTINGS_DATASET, "Plaza", date(2024, 9, 1))
+    assert os.listdir(partition_dir) == [archive.COMPACTED_FILE_NAME]
+
+    table = query_archive(
+        columns=["address", "total_rent"], sites=["Plaza"], end=date(2024, 9, 1)
+    )
+    assert table.column_names == ["address", "total_rent"]
+    assert table.num_rows == 9
+    assert sorted(set(table["total_rent"].to_pylist())) == [720.0, 780.5, 1300.0]
+
+    assert query_archive(sites=["plaza"], start=date(2024, 9, 2)).num_rows == 1
+    assert query_archive(sites=["Maasland"]).num_rows == 1
+
+
+def test_compaction_is_idempotent_after_interruption(monkeypatch):
+    for minute in (0, 5):
+        append_snapshot(
+            "Plaza", ITEMS, datetime(2024, 9, 1, 12, minute, tzinfo=timezone.utc)
+        )
+
+    # Simulate a crash after the compacted file is written but before the sources are removed
+    remove = os.remove
+
+    def failing_remove(path):
+        if os.path.basename(path) == archive.LOCK_FILE_NAME:
+            return remove(path)
+        raise OSError("interrupted")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(archive.os, "remove", failing_remove)
+        with pytest.raises(OSError):
+            compact_partition(LISTINGS_DATASET, "Plaza", date(2024, 9, 1))
+
+    # Readers skip the source files already merged into the compacted file
+    assert query_archive(end=date(2024, 9, 1)).num_rows == 6
+
+    compact_partition(LISTINGS_DATASET, "Plaza", date(2024, 9, 1))
+    compact_partition(LISTINGS_DATASET, "Plaza", date(2024, 9, 1))
+
+    assert query_archive(end=date(2024, 9, 1)).num_rows == 6
+
+
+def test_empty_scrapes_are_logged():
+    append_snapshot("Maasland", ITEMS, datetime(2024, 9, 1, 12, 0, tzinfo=timezone.utc))
+    assert (
+        append_snapshot("Maasland", [], datetime(2024, 9, 1, 12, 5, tzinfo=timezone.utc))
+        is None
+    )
+
+    scrapes = query_scrapes(
+        columns=["scraped_at", "listings"], sites=["Maasland"]
+    ).sort_by("scraped_at")
+    assert scrapes["listings"].to_pylist() == [3, 0]
+    assert query_archive(sites=["Maasland"]).num_rows == 3
+
+
+def test_query_empty_archive():
+    assert query_archive(columns=["total_rent"]).num_rows == 0
+    assert query_scrapes().num_rows == 0
+
+
+def test_concurrent_compactions_do_not_lose_rows(monkeypatch):
+    for minute in (0, 5):
+        append_snapshot(
+            "Plaza", ITEMS, datetime(2024, 9, 1, 12, minute, tzinfo=timezone.utc)
+        )
+    day = date(2024, 9, 1)
+    partition_dir = archive._partition_dir(LISTINGS_DATASET, "Plaza", day)
+
+    # Run B reads the (missing) compacted file, then run A compacts the whole partition
+    read_file = archive._read_file
+
+    def interleaved_read_file(file_path):
+        compacted = read_file(file_path)
+        monkeypatch.setattr(archive, "_read_file", read_file)
+        compact_partition(LISTINGS_DATASET, "Plaza", day)
+        return compacted
+
+    monkeypatch.setattr(archive, "_read_file", interleaved_read_file)
+    compact_partition(LISTINGS_DATASET, "Plaza", day)
+    # Run A runs again after B has finished
+    compact_partition(LISTINGS_DATASET, "Plaza", day)
+
+    assert os.listdir(partition_dir) == [archive.COMPACTED_FILE_NAME]
+    assert query_archive(end=day).num_rows == 6
+
+
+def test_stale_lock_is_taken_over():
+    for minute in (0, 5):
+        append_snapshot(
+            "Plaza", ITEMS, datetime(2024, 9, 1, 12, minute, tzinfo=timezone.utc)
+        )
+    day = date(2024, 9, 1)
+    partition_dir = archive._partition_dir(LISTINGS_DATASET, "Plaza", day)
+    lock_path = os.path.join(partition_dir, archive.LOCK_FILE_NAME)
+
+    open(lock_path, "w").close()
+    compact_partition(LISTINGS_DATASET, "Plaza", day)
+    assert len(os.listdir(partition_dir)) == 3
+
+    stale = time.time() - archive.LOCK_TIMEOUT - 1
+    os.utime(lock_path, (stale, stale))
+    compact_partition(LISTINGS_DATASET, "Plaza", day)
+    assert os.listdir(partition_dir) == [archive.COMPACTED_FILE_NAME]
+    assert query_archive(end=day).num_rows == 6